@@ -2,10 +2,19 @@ import os
 import logging
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 import aiohttp
 import json
+import re
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import asyncio
-from datetime import datetime
+import threading
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
 
 # Set up logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -14,45 +23,173 @@ logger = logging.getLogger(__name__)
 TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 USER_DATA_FILE = os.environ.get('USER_DATA_FILE', 'demexhealthchatids.json')
 CHECK_INTERVAL = int(os.environ.get('CHECK_INTERVAL', 3600))  # Default to 1 hour
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public base URL; polling is used when unset
+PORT = int(os.environ.get('PORT', 8443))
 
-# File to store user data
-USER_DATA_FILE = 'demexhealthchatids.json'
+# Demex addresses: 'swth1' followed by 38 bech32 characters
+ADDRESS_RE = re.compile(r'swth1[02-9ac-hj-np-z]{38}')
+
+# Monitoring settings for a single chat
+@dataclass(slots=True)
+class Monitor:
+    threshold: float
+    address: str
 
 # Load user data from file
 def load_user_data():
     try:
-        with open(USER_DATA_FILE, 'r') as f:
+        with open(USER_DATA_FILE, 'rb') as f:
             content = f.read().strip()
             if content:
-                return json.loads(content)
+                data = orjson.loads(content) if orjson else json.loads(content)
+                monitors = {}
+                for chat_id, entry in data.items():
+                    try:
+                        monitors[chat_id] = Monitor(entry['threshold'], entry['address'])
+                    except (KeyError, TypeError) as e:
+                        logger.error(f"Skipping malformed user data for chat {chat_id}: {e!r}")
+                return monitors
             else:
                 return {}
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
-# Save user data to file
-def save_user_data(data):
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(data, f)
+# Write user data to file atomically so a crash never leaves a partial file
+def write_user_data(data):
+    tmp_file = USER_DATA_FILE + '.tmp'
+    with _write_lock:
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(data) if orjson else json.dumps(data).encode())
+        os.replace(tmp_file, USER_DATA_FILE)
+
+# Mark user data as changed; flush_user_data_loop writes it out shortly after
+def save_user_data():
+    _dirty.set()
+
+# Background task that batches user data writes
+async def flush_user_data_loop():
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(SAVE_DELAY)
+        # Clear before snapshotting so changes made during the write trigger another flush
+        _dirty.clear()
+        try:
+            await asyncio.to_thread(write_user_data, snapshot_user_data())
+        except Exception:
+            logger.exception("Failed to save user data, will retry")
+            _dirty.set()
+
+# Copy user data so it can be serialized off the event loop
+def snapshot_user_data():
+    return {chat_id: asdict(entry) for chat_id, entry in user_data.items()}
 
 # Global variable to store user data
 user_data = load_user_data()
 
-# Function to check health factor
+# Seconds to wait after a change before writing user data to disk
+SAVE_DELAY = 2.0
+_dirty = asyncio.Event()
+_flush_task = None
+_write_lock = threading.Lock()
+
+# Prevents overlapping periodic checks when a tick outlasts CHECK_INTERVAL
+_tick_lock = asyncio.Lock()
+
+# Cache of address -> (fetched_at, health_factor), plus per-address locks so
+# concurrent lookups of the same address share a single upstream request.
+# Expired entries and unused locks are dropped so memory stays bounded.
+# Kept short so replies never show a stale health factor
+HF_CACHE_TTL = 30
+_HF_CACHE = {}
+_HF_LOCKS = {}
+
+# Shared HTTP session, created in post_init and closed in post_shutdown
+SESSION = None
+# Bound slow API calls so one request can't stall a periodic check
+API_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+# Largest error response body worth reading to keep the connection alive
+MAX_ERROR_BODY = 64 * 1024
+
+# Function to create the shared HTTP session and start the user data writer
+async def post_init(application: Application) -> None:
+    global SESSION, _flush_task
+    connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=75)
+    SESSION = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+    _flush_task = asyncio.create_task(flush_user_data_loop())
+
+# Function to close the shared HTTP session and flush pending user data
+async def post_shutdown(application: Application) -> None:
+    if _flush_task is not None:
+        _flush_task.cancel()
+        # Wait for the flusher to stop so its write can't overlap the final one
+        await asyncio.gather(_flush_task, return_exceptions=True)
+    if _dirty.is_set():
+        _dirty.clear()
+        try:
+            await asyncio.to_thread(write_user_data, snapshot_user_data())
+        except Exception:
+            logger.exception("Failed to save user data on shutdown, pending changes were lost")
+    if SESSION is not None:
+        await SESSION.close()
+
+# Function to check health factor, served from cache when fresh
 async def check_health_factor(address):
+    cached = _HF_CACHE.get(address)
+    if cached is not None and time.monotonic() - cached[0] < HF_CACHE_TTL:
+        return cached[1]
+
+    # Each lock entry is [lock, number of tasks using it] so it can be dropped when unused
+    entry = _HF_LOCKS.get(address)
+    if entry is None:
+        entry = _HF_LOCKS[address] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # Another task may have filled the cache while we waited on the lock
+            cached = _HF_CACHE.get(address)
+            if cached is not None and time.monotonic() - cached[0] < HF_CACHE_TTL:
+                return cached[1]
+
+            health_factor = await fetch_health_factor(address)
+            if health_factor is not None:
+                prune_hf_cache()
+                # Re-insert so the cache stays ordered oldest-first
+                _HF_CACHE.pop(address, None)
+                _HF_CACHE[address] = (time.monotonic(), health_factor)
+            return health_factor
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _HF_LOCKS[address]
+
+# Function to drop expired health factor cache entries. Entries are kept in
+# fetch order, so this stops at the first fresh one instead of scanning the cache
+def prune_hf_cache():
+    now = time.monotonic()
+    while _HF_CACHE:
+        address, (fetched_at, _) = next(iter(_HF_CACHE.items()))
+        if now - fetched_at < HF_CACHE_TTL:
+            break
+        del _HF_CACHE[address]
+
+# Function to fetch health factor from the Carbon API
+async def fetch_health_factor(address):
     url = f"https://api.carbon.network/carbon/cdp/v1/health_factor/{address}"
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return float(data.get('health_factor', 0))
-                else:
-                    logger.error(f"Error fetching health factor: HTTP {response.status}")
-                    return None
-        except aiohttp.ClientError as e:
-            logger.error(f"Network error when fetching health factor: {e}")
-            return None
+    try:
+        async with SESSION.get(url, timeout=API_TIMEOUT) as response:
+            if response.status == 200:
+                data = await response.json(loads=orjson.loads if orjson else json.loads)
+                return float(data.get('health_factor', 0))
+            else:
+                logger.error(f"Error fetching health factor: HTTP {response.status}")
+                # Drain small error bodies so the connection can be reused from the pool;
+                # large or unknown-length bodies are left unread and the connection is closed
+                if response.content_length is not None and response.content_length <= MAX_ERROR_BODY:
+                    await response.read()
+                return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Network error when fetching health factor: {e}")
+        return None
 
 # Function to handle the /start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -80,19 +217,19 @@ async def monitor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     threshold = float(context.args[0])
     address = context.args[1]
 
-    if not address.startswith('swth'):
-        await update.message.reply_text("Invalid address. Demex addresses must start with 'swth'.")
+    if not ADDRESS_RE.fullmatch(address):
+        await update.message.reply_text("Invalid address. Demex addresses start with 'swth1' and are 43 characters long.")
         return
 
     if chat_id in user_data:
-        user_data[chat_id]['threshold'] = threshold
-        user_data[chat_id]['address'] = address
+        user_data[chat_id].threshold = threshold
+        user_data[chat_id].address = address
         message = f"Updated monitoring for address {address} with new threshold {threshold}"
     else:
-        user_data[chat_id] = {'threshold': threshold, 'address': address}
+        user_data[chat_id] = Monitor(threshold=threshold, address=address)
         message = f"Started monitoring address {address} with threshold {threshold}"
 
-    save_user_data(user_data)
+    save_user_data()
     await update.message.reply_text(message)
     await check_and_notify(context, chat_id)
 
@@ -100,8 +237,8 @@ async def monitor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = str(update.effective_chat.id)
     if chat_id in user_data:
-        threshold = user_data[chat_id]['threshold']
-        address = user_data[chat_id]['address']
+        threshold = user_data[chat_id].threshold
+        address = user_data[chat_id].address
         health_factor = await check_health_factor(address)
         
         if health_factor is not None:
@@ -124,7 +261,7 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = str(update.effective_chat.id)
     if chat_id in user_data:
         del user_data[chat_id]
-        save_user_data(user_data)
+        save_user_data()
         await update.message.reply_text("Monitoring stopped.")
     else:
         await update.message.reply_text("You were not monitoring any address.")
@@ -132,8 +269,8 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # Function to handle direct address input
 async def handle_address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     address = update.message.text.strip()
-    if not address.startswith('swth'):
-        await update.message.reply_text("Invalid address. Demex addresses must start with 'swth'.")
+    if not ADDRESS_RE.fullmatch(address):
+        await update.message.reply_text("Invalid address. Demex addresses start with 'swth1' and are 43 characters long.")
         return
 
     health_factor = await check_health_factor(address)
@@ -149,10 +286,13 @@ async def check_and_notify(context: ContextTypes.DEFAULT_TYPE, chat_id: str) ->
     if chat_id not in user_data:
         return
 
-    address = user_data[chat_id]['address']
-    threshold = user_data[chat_id]['threshold']
+    address = user_data[chat_id].address
+    threshold = user_data[chat_id].threshold
     health_factor = await check_health_factor(address)
+    await notify(context, chat_id, address, threshold, health_factor)
 
+# Function to notify a user if their health factor is below threshold or unavailable
+async def notify(context: ContextTypes.DEFAULT_TYPE, chat_id: str, address: str, threshold: float, health_factor) -> None:
     if health_factor is not None:
         if health_factor < threshold:
             await context.bot.send_message(
@@ -168,15 +308,64 @@ async def check_and_notify(context: ContextTypes.DEFAULT_TYPE, chat_id: str) ->
 
 # Function to periodically check health factors
 async def periodic_check(context: ContextTypes.DEFAULT_TYPE) -> None:
-    for chat_id in user_data:
-        await check_and_notify(context, chat_id)
+    # Skip this tick if the previous one is still running
+    if _tick_lock.locked():
+        logger.warning("Previous periodic check still running, skipping this tick")
+        return
+
+    async with _tick_lock:
+        # Group monitors by address so each unique address is fetched once per tick.
+        # Iterate over a snapshot since /monitor and /stop may mutate user_data
+        by_addr = {}
+        for chat_id, entry in list(user_data.items()):
+            by_addr.setdefault(entry.address, []).append(chat_id)
+
+        # Bound concurrency so a large user list doesn't stampede the APIs
+        sem = asyncio.Semaphore(16)
+
+        async def _guarded(coro):
+            async with sem:
+                return await coro
+
+        addresses = list(by_addr)
+        health_factors = await asyncio.gather(
+            *[_guarded(check_health_factor(address)) for address in addresses], return_exceptions=True
+        )
+
+        pending = []
+        for address, health_factor in zip(addresses, health_factors):
+            if isinstance(health_factor, Exception):
+                logger.error(f"Periodic check failed for address {address}: {health_factor}")
+                health_factor = None
+            for chat_id in by_addr[address]:
+                # Re-read settings since the chat may have run /stop or /monitor during the fetch
+                entry = user_data.get(chat_id)
+                if entry is None or entry.address != address:
+                    continue
+                pending.append((chat_id, notify(context, chat_id, address, entry.threshold, health_factor)))
+
+        results = await asyncio.gather(*[_guarded(coro) for _, coro in pending], return_exceptions=True)
+        for (chat_id, _), result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(f"Periodic check failed for chat {chat_id}: {result}")
 
 def main() -> None:
+    logger.info("Bot starting at %s", datetime.now(tz=timezone.utc).isoformat())
     if not TOKEN:
         logger.error("No bot token provided. Please set the TELEGRAM_BOT_TOKEN environment variable.")
         return
 
-    application = Application.builder().token(TOKEN).build()
+    # Larger pool for bot API calls so concurrent alerts don't queue on connections
+    request = HTTPXRequest(connection_pool_size=64, pool_timeout=10.0, connect_timeout=5.0, read_timeout=10.0)
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(HTTPXRequest(connection_pool_size=8))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -189,8 +378,18 @@ def main() -> None:
     job_queue = application.job_queue
     job_queue.run_repeating(periodic_check, interval=CHECK_INTERVAL, first=5)
 
-    logger.info("Bot started. Polling for updates...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        logger.info("Bot started. Listening for webhook updates...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("Bot started. Polling for updates...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()